@@ -26,6 +26,16 @@ from scriptHandler import script
 #: the non-printable unicode character that represents the end of cell or end of row mark in Microsoft Word
 END_OF_ROW_MARK = '\x07'
 
+#: Translation table applied to text fetched from Word documents:
+#: vertical tabs (exposed a lot in HTML emails) become carriage returns,
+#: and end-of-row marks are removed as they are not useful.
+_TEXT_TRANSLATION_TABLE = str.maketrans({'\v': '\r', END_OF_ROW_MARK: None})
+
+#: The UIA automation ID prefix of page elements in Microsoft Word, followed by the page number
+_PAGE_AUTOMATION_ID_PREFIX = 'UIA_AutomationId_Word_Page_'
+#: The UIA automation ID prefix of the editable text fields surrounding most inner fields in Microsoft Word
+_CONTENT_AUTOMATION_ID_PREFIX = 'UIA_AutomationId_Word_Content'
+
 class ElementsListDialog(browseMode.ElementsListDialog):
 
 	ELEMENT_TYPES=(browseMode.ElementsListDialog.ELEMENT_TYPES[0],browseMode.ElementsListDialog.ELEMENT_TYPES[1],
@@ -44,16 +54,54 @@ class RevisionUIATextInfoQuickNavItem(TextAttribUIATextInfoQuickNavItem):
 	@property
 	def label(self):
 		text=self.textInfo.text
-		if UIAHandler.AnnotationType_InsertionChange in self.attribValues:
+		attribValues = self.attribValues
+		if UIAHandler.AnnotationType_InsertionChange in attribValues:
 			# Translators: The label shown for an insertion change 
 			return _(u"insertion: {text}").format(text=text)
-		elif UIAHandler.AnnotationType_DeletionChange in self.attribValues:
+		elif UIAHandler.AnnotationType_DeletionChange in attribValues:
 			# Translators: The label shown for a deletion change 
 			return _(u"deletion: {text}").format(text=text)
 		else:
 			# Translators: The general label shown for track changes 
 			return _(u"track change: {text}").format(text=text)
 
+#: The UIA properties fetched for each annotation element when looking up comment information.
+_commentUIACachedPropertyIDs = (
+	UIAHandler.UIA_AnnotationAnnotationTypeIdPropertyId,
+	UIAHandler.UIA_NamePropertyId,
+	UIAHandler.UIA_AnnotationAuthorPropertyId,
+	UIAHandler.UIA_AnnotationDateTimePropertyId,
+)
+_commentCacheRequest = None
+
+
+def _getCommentCacheRequest():
+	""" The UIA cacheRequest used to fetch all the needed properties of annotation elements for comments, created on first use."""
+	global _commentCacheRequest
+	if _commentCacheRequest is None:
+		cacheRequest = UIAHandler.handler.baseCacheRequest.clone()
+		for ID in _commentUIACachedPropertyIDs:
+			try:
+				cacheRequest.addProperty(ID)
+			except COMError:
+				pass
+		_commentCacheRequest = cacheRequest
+	return _commentCacheRequest
+
+
+_annotationParentCacheRequest = None
+
+
+def _getAnnotationParentCacheRequest():
+	""" The UIA cacheRequest used when fetching the parent of a non-comment annotation element, created on first use."""
+	global _annotationParentCacheRequest
+	if _annotationParentCacheRequest is None:
+		cacheRequest = UIAHandler.handler.clientObject.createCacheRequest()
+		cacheRequest.addProperty(UIAHandler.UIA_IsAnnotationPatternAvailablePropertyId)
+		_annotationParentCacheRequest = cacheRequest
+	return _annotationParentCacheRequest
+
+
 def getCommentInfoFromPosition(position):
 	"""
 	Fetches information about the comment located at the given position in a word document.
@@ -69,26 +117,40 @@ def getCommentInfoFromPosition(position):
 		UIAElementArray=val.QueryInterface(UIAHandler.IUIAutomationElementArray)
 	except COMError:
 		return
+	# Fetch all the comment properties we need in one go when building each element's cache,
+	# rather than making a separate cross-process call for each property.
+	cacheRequest = _getCommentCacheRequest()
+	typeIDPropertyId = UIAHandler.UIA_AnnotationAnnotationTypeIdPropertyId
+	commentTypeID = UIAHandler.AnnotationType_Comment
 	for index in range(UIAElementArray.length):
 		UIAElement=UIAElementArray.getElement(index)
-		UIAElement=UIAElement.buildUpdatedCache(UIAHandler.handler.baseCacheRequest)
-		typeID = UIAElement.GetCurrentPropertyValue(UIAHandler.UIA_AnnotationAnnotationTypeIdPropertyId)
+		UIAElement = UIAElement.buildUpdatedCache(cacheRequest)
+		typeID = UIAElement.GetCachedPropertyValue(typeIDPropertyId)
 		# Use Annotation Type Comment if available
-		if typeID == UIAHandler.AnnotationType_Comment:
-			comment = UIAElement.GetCurrentPropertyValue(UIAHandler.UIA_NamePropertyId)
-			author = UIAElement.GetCurrentPropertyValue(UIAHandler.UIA_AnnotationAuthorPropertyId)
-			date = UIAElement.GetCurrentPropertyValue(UIAHandler.UIA_AnnotationDateTimePropertyId)
+		if typeID == commentTypeID:
+			comment = UIAElement.GetCachedPropertyValue(UIAHandler.UIA_NamePropertyId)
+			author = UIAElement.GetCachedPropertyValue(UIAHandler.UIA_AnnotationAuthorPropertyId)
+			date = UIAElement.GetCachedPropertyValue(UIAHandler.UIA_AnnotationDateTimePropertyId)
 			return dict(comment=comment, author=author, date=date)
 		else:
-			obj = UIA(UIAElement=UIAElement)
+			# Fetch the parent along with its annotation pattern availability in one call,
+			# rather than walking to the parent and then querying the property separately.
+			try:
+				parentElement = UIAHandler.handler.baseTreeWalker.GetParentElementBuildCache(
+					UIAElement,
+					_getAnnotationParentCacheRequest()
+				)
+			except COMError:
+				parentElement = None
 			if (
-				not obj.parent
+				not parentElement
 				# Because the name of this object is language sensetive check if it has UIA Annotation Pattern
-				or not obj.parent.UIAElement.getCurrentPropertyValue(
+				or not parentElement.GetCachedPropertyValue(
 					UIAHandler.UIA_IsAnnotationPatternAvailablePropertyId
 				)
 			):
 				continue
+			obj = UIA(UIAElement=UIAElement)
 			comment = obj.makeTextInfo(textInfos.POSITION_ALL).text
 			tempObj = obj.previous.previous
 			authorObj = tempObj or obj.previous
@@ -153,23 +215,27 @@ class WordDocumentTextInfo(UIATextInfo):
 			startOfNode=startOfNode,
 			endOfNode=endOfNode
 		)
-		if automationID.startswith('UIA_AutomationId_Word_Page_'):
-			field['page-number']=automationID.rsplit('_',1)[-1]
-		elif obj.UIAElement.cachedControlType==UIAHandler.UIA_GroupControlTypeId and obj.name:
+		# Both the automation ID and control type are part of the base UIA cache request,
+		# and name is in _controlFieldUIACachedPropertyIDs, so none of these need a cross-process call.
+		controlType = obj.UIAElement.cachedControlType
+		if automationID.startswith(_PAGE_AUTOMATION_ID_PREFIX):
+			field['page-number'] = automationID[len(_PAGE_AUTOMATION_ID_PREFIX):]
+		elif controlType == UIAHandler.UIA_GroupControlTypeId and obj.name:
 			field['role']=controlTypes.Role.EMBEDDEDOBJECT
 			field['alwaysReportName']=True
-		elif obj.UIAElement.cachedControlType==UIAHandler.UIA_CustomControlTypeId and obj.name:
+		elif controlType == UIAHandler.UIA_CustomControlTypeId and obj.name:
 			# Include foot note and endnote identifiers
 			field['content']=obj.name
 			field['role']=controlTypes.Role.LINK
-		if obj.role==controlTypes.Role.LIST or obj.role==controlTypes.Role.EDITABLETEXT:
+		role = obj.role
+		if role == controlTypes.Role.LIST or role == controlTypes.Role.EDITABLETEXT:
 			field['states'].add(controlTypes.State.READONLY)
-			if obj.role==controlTypes.Role.LIST:
+			if role == controlTypes.Role.LIST:
 				# To stay compatible with the older MS Word implementation, don't expose lists in word documents as actual lists. This suppresses announcement of entering and exiting them.
 				# Note that bullets and numbering are still announced of course.
 				# Eventually we'll want to stop suppressing this, but for now this is more confusing than good (as in many cases announcing of new bullets when pressing enter causes exit and then enter to be spoken).
 				field['role']=controlTypes.Role.EDITABLETEXT
-		if obj.role==controlTypes.Role.GRAPHIC:
+		if role == controlTypes.Role.GRAPHIC:
 			# Label graphics with a description before name as name seems to be auto-generated (E.g. "rectangle")
 			field['content'] = (
 				field.pop('description', None)
@@ -182,18 +248,16 @@ class WordDocumentTextInfo(UIATextInfo):
 	def _getTextFromUIARange(self, textRange):
 		t=super(WordDocumentTextInfo,self)._getTextFromUIARange(textRange)
 		if t:
-			# HTML emails expose a lot of vertical tab chars in their text
-			# Really better as carage returns
-			t=t.replace('\v','\r')
-			# Remove end-of-row markers from the text - they are not useful
-			t = t.replace(END_OF_ROW_MARK, '')
+			# Replace vertical tabs and remove end-of-row marks in a single pass
+			t = t.translate(_TEXT_TRANSLATION_TABLE)
 		return t
 
 	def _isEndOfRow(self):
 		""" Is this textInfo positioned on an end-of-row mark? """
 		info=self.copy()
 		info.expand(textInfos.UNIT_CHARACTER)
-		return info._rangeObj.getText(-1)==u'\u0007'
+		# Only the first character is needed, so don't ask for more.
+		return info._rangeObj.getText(1) == END_OF_ROW_MARK
 
 	def move(self,unit,direction,endPoint=None):
 		if endPoint is None:
@@ -218,7 +282,7 @@ class WordDocumentTextInfo(UIATextInfo):
 				self.setEndPoint(docInfo,"endToEnd")
 
 	def getTextWithFields(self,formatConfig=None):
-		fields = None
+		info = self
 		# #11043: when a non-collapsed text range is positioned within a blank table cell
 		# MS Word does not return the table  cell as an enclosing element,
 		# Thus NVDa thinks the range is not inside the cell.
@@ -232,23 +296,24 @@ class WordDocumentTextInfo(UIATextInfo):
 		if not self.isCollapsed:
 			rawText = self._rangeObj.GetText(2)
 			if not rawText or rawText == END_OF_ROW_MARK:
-				r = self.copy()
-				r.end = r.start
-				fields = super(WordDocumentTextInfo, r).getTextWithFields(formatConfig=formatConfig)
-		if fields is None:
-			fields = super().getTextWithFields(formatConfig=formatConfig)
+				info = self.copy()
+				info.collapse()
+		fields = super(WordDocumentTextInfo, info).getTextWithFields(formatConfig=formatConfig)
 		if len(fields)==0: 
 			# Nothing to do... was probably a collapsed range.
 			return fields
+		# These loops can walk thousands of fields on a large page, so avoid repeated global lookups.
+		FieldCommand = textInfos.FieldCommand
 		# Sometimes embedded objects and graphics In MS Word can cause a controlStart then a controlEnd with no actual formatChange / text in the middle.
 		# SpeakTextInfo always expects that the first lot of controlStarts will always contain some text.
 		# Therefore ensure that the first lot of controlStarts does contain some text by inserting a blank formatChange and empty string in this case.
 		for index in range(len(fields)):
 			field=fields[index]
-			if isinstance(field,textInfos.FieldCommand) and field.command=="controlStart":
+			command = field.command if isinstance(field, FieldCommand) else None
+			if command == "controlStart":
 				continue
-			elif isinstance(field,textInfos.FieldCommand) and field.command=="controlEnd":
-				formatChange=textInfos.FieldCommand("formatChange",textInfos.FormatField())
+			elif command == "controlEnd":
+				formatChange = FieldCommand("formatChange", textInfos.FormatField())
 				fields.insert(index,formatChange)
 				fields.insert(index+1,"")
 			break
@@ -259,19 +324,19 @@ class WordDocumentTextInfo(UIATextInfo):
 		lastFormatField=None
 		for index in range(len(fields)):
 			field=fields[index]
-			if isinstance(field,textInfos.FieldCommand) and field.command=="controlStart":
+			command = field.command if isinstance(field, FieldCommand) else None
+			if command == "controlStart":
 				if field.field.get('role')==controlTypes.Role.LISTITEM and field.field.get('_startOfNode'):
 					# We are in the start of a list item.
 					listItemStarted=True
-			elif isinstance(field,textInfos.FieldCommand) and field.command=="formatChange":
+			elif command == "formatChange":
 				# This is the most recent formatField we have seen.
 				lastFormatField=field.field
 			elif listItemStarted and isinstance(field,str):
 				# This is the first text string within the list.
 				# Remove the text up to the first space, and store it as line-prefix which NVDA will appropriately speak/braille as a bullet.
-				try:
-					spaceIndex=field.index(' ')
-				except ValueError:
+				spaceIndex = field.find(' ')
+				if spaceIndex == -1:
 					log.debugWarning("No space found in this text string")
 					break
 				prefix=field[0:spaceIndex]
@@ -288,48 +353,53 @@ class WordDocumentTextInfo(UIATextInfo):
 			page=fields[0].field['page-number']
 		except KeyError:
 			page=None
-		if page is not None:
-			for field in fields:
-				if isinstance(field,textInfos.FieldCommand) and isinstance(field.field,textInfos.FormatField):
-					field.field['page-number']=page
+		FormatField = textInfos.FormatField
 		# MS Word can sometimes return a higher ancestor in its textRange's children.
 		# E.g. a table inside a table header.
 		# This does not cause a loop, but does cause information to be doubled
 		# Detect these duplicates and remove them from the generated fields.
+		# This is done in the same pass as filling in the page numbers.
 		seenStarts=set()
-		pendingRemoves=[]
-		index=0
-		for index,field in enumerate(fields):
-			if isinstance(field,textInfos.FieldCommand) and field.command=="controlStart":
-				runtimeID=field.field['runtimeID']
+		# Identities of the duplicate fields, so that removal is a set lookup rather than a scan.
+		pendingRemoveIDs = set()
+		for field in fields:
+			if not isinstance(field, FieldCommand):
+				if seenStarts:
+					seenStarts.clear()
+				continue
+			command = field.command
+			fieldData = field.field
+			if page is not None and isinstance(fieldData, FormatField):
+				fieldData['page-number'] = page
+			if command == "controlStart":
+				runtimeID = fieldData.get('runtimeID')
+				# Skip hashing for control fields that have no runtime ID
 				if not runtimeID:
 					continue
 				if runtimeID in seenStarts:
-					pendingRemoves.append(field.field)
+					pendingRemoveIDs.add(id(fieldData))
 				else:
 					seenStarts.add(runtimeID)
 			elif seenStarts:
 				seenStarts.clear()
-		index=0
-		while index<len(fields):
-			field=fields[index]
-			if isinstance(field,textInfos.FieldCommand) and any(x is field.field for x in pendingRemoves):
-				del fields[index]
-			else:
-				index+=1
+		if pendingRemoveIDs:
+			fields = [
+				field for field in fields
+				if not (isinstance(field, FieldCommand) and id(field.field) in pendingRemoveIDs)
+			]
 		return fields
 
 class WordBrowseModeDocument(UIABrowseModeDocument):
 
 	def shouldSetFocusToObj(self,obj):
 		# Ignore strange editable text fields surrounding most inner fields (links, table cells etc) 
-		if obj.role==controlTypes.Role.EDITABLETEXT and obj.UIAElement.cachedAutomationID.startswith('UIA_AutomationId_Word_Content'):
+		if obj.role==controlTypes.Role.EDITABLETEXT and obj.UIAElement.cachedAutomationID.startswith(_CONTENT_AUTOMATION_ID_PREFIX):
 			return False
 		return super(WordBrowseModeDocument,self).shouldSetFocusToObj(obj)
 
 	def shouldPassThrough(self,obj,reason=None):
 		# Ignore strange editable text fields surrounding most inner fields (links, table cells etc) 
-		if obj.role==controlTypes.Role.EDITABLETEXT and obj.UIAElement.cachedAutomationID.startswith('UIA_AutomationId_Word_Content'):
+		if obj.role==controlTypes.Role.EDITABLETEXT and obj.UIAElement.cachedAutomationID.startswith(_CONTENT_AUTOMATION_ID_PREFIX):
 			return False
 		return super(WordBrowseModeDocument,self).shouldPassThrough(obj,reason=reason)
 